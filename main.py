@@ -1,17 +1,19 @@
 import logging
 import os
+import re
 import asyncio
-import json
-from collections import deque
+import orjson
+from collections import OrderedDict
 import google.generativeai as genai
-import html
-import time
 import uuid
+import hashlib
 import psycopg
 from datetime import datetime, timezone
+from types import MappingProxyType
+from difflib import SequenceMatcher
 import pytz
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LinkPreviewOptions
 from telegram.ext import (
     Application,
     MessageHandler,
@@ -43,7 +45,7 @@ if MY_TELEGRAM_ID_STR:
     try:
         MY_TELEGRAM_ID = int(MY_TELEGRAM_ID_STR)
     except ValueError:
-        logger.critical(f"CRITICAL: MY_TELEGRAM_ID ('{MY_TELEGRAM_ID_STR}') is not a valid integer. Bot cannot operate.")
+        logger.critical("CRITICAL: MY_TELEGRAM_ID ('%s') is not a valid integer. Bot cannot operate.", MY_TELEGRAM_ID_STR)
         exit()
 else:
     logger.critical("CRITICAL: Missing MY_TELEGRAM_ID in environment variables. Bot cannot operate.")
@@ -51,323 +53,590 @@ else:
 
 # --- Остальные глобальные переменные ---
 MAX_HISTORY_PER_CHAT = 700
+HISTORY_TOKEN_BUDGET = 16000 # Сколько токенов истории (оценка len // 4) уходит в Gemini
+HOT_HISTORY_CHATS = 256 # Сколько чатов держим в памяти поверх БД
 DEBOUNCE_DELAY = 1
+EDIT_SIMILARITY_THRESHOLD = 0.9 # Правки с большим сходством не запускают новую генерацию
+MAX_DEBOUNCE_CHATS = 1024
+MAX_PENDING_REPLIES = 1024
+PENDING_REPLY_TTL = 3600 # сек, сколько неотправленная подсказка живет в памяти и в БД
+PENDING_REPLY_SWEEP_INTERVAL = 60
 MY_NAME_FOR_HISTORY = "киткат"
 MESSAGE_SPLIT_DELAY = 2
+LAST_SEND_PRUNE_SIZE = 256
+TELEGRAM_GLOBAL_RATE = 25 # сообщений/сек, с запасом от лимита Telegram в 30/сек
+TELEGRAM_POOL_TIMEOUT = 5.0 # сек ожидания свободного соединения к Bot API
 GEMINI_MODEL_NAME = "gemini-2.0-flash"
+MAX_INFLIGHT_GEMINI = 8 # Единственное ограничение параллельности: держится только на время вызова Gemini
+GEMINI_RESULT_TTL = 30 # сек, сколько помним ответ на точно такой же запрос
+GEMINI_RESULT_CACHE_SIZE = 64
+GEMINI_WARMUP_TIMEOUT = 5 # сек, дольше прогрев не ждем
+STREAM_EDIT_INTERVAL = 0.7 # сек между правками превью, пока Gemini стримит ответ
 
 BASE_SYSTEM_PROMPT = ""
 MY_CHARACTER_DESCRIPTION = ""
 TOOLS_PROMPT = ""
-CHAR_DESCRIPTIONS = {}
-
-debounce_tasks = {}
-pending_replies = {}
+CHAR_DESCRIPTIONS = MappingProxyType({}) # int user_id -> описание
+CHAR_PROMPT_TAILS = MappingProxyType({}) # int user_id -> готовый хвост фрагмента промпта ", ID: ...):\n<описание>\n\n"
+# Заранее собранные статичные куски контекстного блока (заполняются в parse_config_file)
+MY_CONTEXT_BLOCK = ""; MY_CONTEXT_REMINDER_BLOCK = ""; TOOLS_CONTEXT_BLOCK = ""
+CONFIG_SECTION_RE = re.compile(r"^[ \t]*!!(.+?)[ \t]*$", re.MULTILINE)
+# Строка CHARS: "<id> = <описание>" или (третья группа) любая другая строка с '=', о которой нужно предупредить
+CHAR_LINE_RE = re.compile(r"^(?:[^\S\n]*(\d+)[^\S\n]*=[^\S\n]*(.*\S)[^\S\n]*|(.*=.*))$", re.MULTILINE)
+NO_LINK_PREVIEW = LinkPreviewOptions(is_disabled=True) # Для служебных сообщений с превью ответа
+NEWMSG_SPLIT_RE = re.compile(r"\s*!NEWMSG!\s*") # Разделитель частей ответа вместе с пробелами вокруг
+REFUSAL_RE = re.compile(r"cannot fulfill|unable to process", re.IGNORECASE) # Один проход без копии ответа в нижнем регистре
+
+# --- Словарь с ограниченным размером: при переполнении вытесняется самая давняя запись ---
+class BoundedDict(OrderedDict):
+    def __init__(self, maxsize: int, on_evict=None):
+        super().__init__(); self.maxsize = maxsize; self.on_evict = on_evict
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value); self.move_to_end(key)
+        if len(self) > self.maxsize:
+            evicted_key, evicted_value = self.popitem(last=False)
+            if self.on_evict: self.on_evict(evicted_key, evicted_value)
+
+def _on_pending_reply_evicted(reply_uuid, pending_data): logger.info("Evicted pending reply %s for chat %s from memory (limit %s reached), it stays in DB.", reply_uuid, pending_data[3], MAX_PENDING_REPLIES)
+def _on_debounce_evicted(chat_id, state): state.cancel(); logger.warning("Evicted and cancelled debounce for chat %s (limit %s reached).", chat_id, MAX_DEBOUNCE_CHATS)
+
+chat_histories = BoundedDict(HOT_HISTORY_CHATS) # chat_id -> ChatRing, LRU-кэш истории из БД
+last_user_message_ids = BoundedDict(HOT_HISTORY_CHATS) # chat_id -> message_id сообщения собеседника, лежащего последним в истории
+debounce_state = BoundedDict(MAX_DEBOUNCE_CHATS, _on_debounce_evicted) # chat_id -> DebounceState
+pending_replies = BoundedDict(MAX_PENDING_REPLIES, _on_pending_reply_evicted) # reply_uuid -> (parts, raw, conn_id, chat_id, created_at loop.time()), горячая копия таблицы pending_replies
 gemini_model = None
+# Общие для всех запросов настройки Gemini (не изменять), передаются модели при создании
+GEMINI_GENERATION_CONFIG = genai.types.GenerationConfig(temperature=0.7)
+GEMINI_SAFETY_SETTINGS = {'HARM_CATEGORY_HARASSMENT': 'block_none', 'HARM_CATEGORY_HATE_SPEECH': 'block_none', 'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'block_none', 'HARM_CATEGORY_DANGEROUS_CONTENT': 'block_none'}
+gemini_semaphore = asyncio.Semaphore(MAX_INFLIGHT_GEMINI)
+background_tasks = [] # Фоновые задачи приложения, отменяются в post_shutdown
+gemini_inflight = {} # blake2b(contents) -> [Task, число ожидающих]
+gemini_recent_results = BoundedDict(GEMINI_RESULT_CACHE_SIZE) # blake2b(contents) -> (истекает_в loop.time(), ответ)
 
 # --- КРИТИЧЕСКИЕ ПРОВЕРКИ ОСТАЛЬНЫХ ПЕРЕМЕННЫХ ---
 if not BOT_TOKEN: logger.critical("CRITICAL: Missing BOT_TOKEN"); exit()
 if not WEBHOOK_URL: logger.critical("CRITICAL: Missing WEBHOOK_URL"); exit()
-if not WEBHOOK_URL.startswith("https://"): logger.critical(f"CRITICAL: WEBHOOK_URL must start with 'https://'"); exit()
+if not WEBHOOK_URL.startswith("https://"): logger.critical("CRITICAL: WEBHOOK_URL must start with 'https://'"); exit()
 # MY_TELEGRAM_ID уже проверен выше
 if not GEMINI_API_KEY: logger.critical("CRITICAL: Missing GEMINI_API_KEY"); exit()
 if not DATABASE_URL: logger.critical("CRITICAL: Missing DATABASE_URL"); exit()
 
 
+# --- Отладочная сериализация в JSON (orjson, с отступами) ---
+def dump_json(obj) -> str: return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
 # --- Функция получения саратовского времени (без изменений) ---
 # ... (код get_saratov_datetime_info) ...
+DAYS_RU = ("понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье")
+saratov_time_cache = [None, ""] # [минута UTC, готовая строка] - строка с точностью до минуты, между генерациями в ту же минуту не пересчитываем
 def get_saratov_datetime_info():
     try:
-        utc_now = datetime.now(timezone.utc); saratov_tz = pytz.timezone('Europe/Saratov'); saratov_now = utc_now.astimezone(saratov_tz)
-        days_ru = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]; day_of_week_ru = days_ru[saratov_now.weekday()]
-        return saratov_now.strftime(f"%Y-%m-%d %H:%M ({day_of_week_ru})")
-    except Exception as e: logger.error(f"Error getting Saratov datetime: {e}"); return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC (Error getting local time)")
+        utc_now = datetime.now(timezone.utc); utc_minute = int(utc_now.timestamp()) // 60
+        if saratov_time_cache[0] == utc_minute: return saratov_time_cache[1]
+        saratov_now = utc_now.astimezone(pytz.timezone('Europe/Saratov'))
+        saratov_time_str = saratov_now.strftime(f"%Y-%m-%d %H:%M ({DAYS_RU[saratov_now.weekday()]})")
+        saratov_time_cache[0] = utc_minute; saratov_time_cache[1] = saratov_time_str
+        return saratov_time_str
+    except Exception as e: logger.error("Error getting Saratov datetime: %s", e); return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC (Error getting local time)")
 
 # --- Функция парсинга конфигурационного файла (без изменений) ---
 # ... (код parse_config_file) ...
 def parse_config_file(filepath: str):
-    global BASE_SYSTEM_PROMPT, MY_CHARACTER_DESCRIPTION,TOOLS_PROMPT, CHAR_DESCRIPTIONS; logger.info(f"Attempting to parse config file: {filepath}")
+    global BASE_SYSTEM_PROMPT, MY_CHARACTER_DESCRIPTION,TOOLS_PROMPT, CHAR_DESCRIPTIONS, CHAR_PROMPT_TAILS, MY_CONTEXT_BLOCK, MY_CONTEXT_REMINDER_BLOCK, TOOLS_CONTEXT_BLOCK; logger.info("Attempting to parse config file: %s", filepath)
     try:
         with open(filepath, 'r', encoding='utf-8') as f: content = f.read()
-        sections = {}; current_section_name = None; current_section_content = []
-        for line in content.splitlines():
-            stripped_line = line.strip()
-            if stripped_line.startswith("!!") and len(stripped_line) > 2:
-                if current_section_name: sections[current_section_name] = "\n".join(current_section_content).strip()
-                current_section_name = stripped_line[2:]; current_section_content = []
-            elif current_section_name is not None: current_section_content.append(line)
-        if current_section_name: sections[current_section_name] = "\n".join(current_section_content).strip()
+        split_content = CONFIG_SECTION_RE.split(content) # [преамбула, имя1, текст1, имя2, текст2, ...]
+        sections = {name: body.strip() for name, body in zip(*[iter(split_content[1:])] * 2)}
         BASE_SYSTEM_PROMPT = sections.get("SYSTEM_PROMPT", "").strip(); MY_CHARACTER_DESCRIPTION = sections.get("MC", "").strip()
-        TOOLS_PROMPT = sections.get("TOOLS", "").strip(); CHAR_DESCRIPTIONS = {}
+        TOOLS_PROMPT = sections.get("TOOLS", "").strip(); char_descriptions = {}
         chars_content = sections.get("CHARS", "")
-        if chars_content:
-            for char_line in chars_content.splitlines():
-                if '=' in char_line:
-                    parts = char_line.split('=', 1); user_id_str = parts[0].strip(); description = parts[1].strip()
-                    if user_id_str.isdigit() and description: CHAR_DESCRIPTIONS[user_id_str] = description
-                    else: logger.warning(f"Skipping invalid line in CHARS section: {char_line}")
-        if not BASE_SYSTEM_PROMPT: logger.error(f"CRITICAL: '!!SYSTEM_PROMPT' not found or empty in {filepath}.")
-        if not TOOLS_PROMPT: logger.warning(f"'!!TOOLS' section not found or empty in {filepath}.")
-        logger.info(f"Config loaded from {filepath}:"); logger.info(f"  SYSTEM_PROMPT: {'Loaded' if BASE_SYSTEM_PROMPT else 'MISSING/EMPTY'}"); logger.info(f"  MY_CHARACTER_DESCRIPTION: {'Loaded' if MY_CHARACTER_DESCRIPTION else 'MISSING/EMPTY'}"); logger.info(f"  TOOLS_PROMPT: {'Loaded' if TOOLS_PROMPT else 'MISSING/EMPTY'}"); logger.info(f"  Loaded {len(CHAR_DESCRIPTIONS)} character descriptions."); logger.debug(f"PARSED CHAR_DESCRIPTIONS: {CHAR_DESCRIPTIONS}")
-    except FileNotFoundError: logger.critical(f"CRITICAL: Configuration file '{filepath}' not found."); exit()
-    except Exception as e: logger.critical(f"CRITICAL: Error parsing config file '{filepath}': {e}", exc_info=True); exit()
+        for user_id_str, description, invalid_line in CHAR_LINE_RE.findall(chars_content): # Строки без '=' регулярка пропускает сама
+            if invalid_line: logger.warning("Skipping invalid line in CHARS section: %s", invalid_line)
+            else: char_descriptions[int(user_id_str)] = description
+        CHAR_DESCRIPTIONS = MappingProxyType(char_descriptions)
+        MY_CONTEXT_BLOCK = f"Немного информации обо мне ({MY_NAME_FOR_HISTORY}):\n{MY_CHARACTER_DESCRIPTION}\n\n" if MY_CHARACTER_DESCRIPTION else ""
+        MY_CONTEXT_REMINDER_BLOCK = f"Напомню информацию обо мне ({MY_NAME_FOR_HISTORY}):\n{MY_CHARACTER_DESCRIPTION}\n\n" if MY_CHARACTER_DESCRIPTION else ""
+        TOOLS_CONTEXT_BLOCK = f"Инструкции по инструментам:\n{TOOLS_PROMPT}\n\n" if TOOLS_PROMPT else ""
+        CHAR_PROMPT_TAILS = MappingProxyType({user_id: f", ID: {user_id}):\n{description}\n\n" for user_id, description in char_descriptions.items()})
+        if not BASE_SYSTEM_PROMPT: logger.error("CRITICAL: '!!SYSTEM_PROMPT' not found or empty in %s.", filepath)
+        if not TOOLS_PROMPT: logger.warning("'!!TOOLS' section not found or empty in %s.", filepath)
+        logger.info("Config loaded from %s:", filepath); logger.info("  SYSTEM_PROMPT: %s", 'Loaded' if BASE_SYSTEM_PROMPT else 'MISSING/EMPTY'); logger.info("  MY_CHARACTER_DESCRIPTION: %s", 'Loaded' if MY_CHARACTER_DESCRIPTION else 'MISSING/EMPTY'); logger.info("  TOOLS_PROMPT: %s", 'Loaded' if TOOLS_PROMPT else 'MISSING/EMPTY'); logger.info("  Loaded %s character descriptions.", len(CHAR_DESCRIPTIONS)); logger.debug("PARSED CHAR_DESCRIPTIONS: %s", CHAR_DESCRIPTIONS)
+    except FileNotFoundError: logger.critical("CRITICAL: Configuration file '%s' not found.", filepath); exit()
+    except Exception as e: logger.critical("CRITICAL: Error parsing config file '%s': %s", filepath, e, exc_info=True); exit()
 
 # --- Функции работы с БД истории (без изменений) ---
 # ... (код init_history_db, update_chat_history, get_formatted_history) ...
+# --- Кольцевой буфер истории чата: роли в bytearray, тексты в списке, dict для Gemini собираются только при чтении ---
+HISTORY_ROLES = ("user", "model"); HISTORY_ROLE_CODES = {role: code for code, role in enumerate(HISTORY_ROLES)}
+class ChatRing:
+    __slots__ = ("roles", "texts", "head", "count")
+    def __init__(self, capacity: int):
+        self.roles = bytearray(capacity); self.texts = [None] * capacity; self.head = 0; self.count = 0
+    def __len__(self): return self.count
+    def append(self, role: str, text: str):
+        capacity = len(self.texts); self.roles[self.head] = HISTORY_ROLE_CODES[role]; self.texts[self.head] = text
+        self.head = (self.head + 1) % capacity
+        if self.count < capacity: self.count += 1
+    def last(self) -> tuple:
+        return (HISTORY_ROLES[self.roles[self.head - 1]], self.texts[self.head - 1]) if self.count else (None, None)
+    def replace_last_text(self, text: str): self.texts[self.head - 1] = text
+    def budget_count(self, token_budget: int) -> int:
+        # Сколько последних записей влезает в бюджет токенов; обрезанная история начинается с реплики собеседника
+        capacity = len(self.texts); tokens = 0; count = 0
+        while count < self.count:
+            tokens += len(self.texts[(self.head - 1 - count) % capacity]) // 4 + 1
+            if tokens > token_budget and count: break
+            count += 1
+        trimmed = count
+        while trimmed < self.count and trimmed > 1 and self.roles[(self.head - trimmed) % capacity] != HISTORY_ROLE_CODES["user"]: trimmed -= 1
+        return trimmed
+    def to_contents(self) -> list:
+        count = self.budget_count(HISTORY_TOKEN_BUDGET)
+        start = self.head - count # Отрицательный start: хвост буфера + его начало до head
+        if start >= 0: return [{"role": HISTORY_ROLES[role], "parts": [{"text": text}]} for role, text in zip(self.roles[start:self.head], self.texts[start:self.head])]
+        contents = [{"role": HISTORY_ROLES[role], "parts": [{"text": text}]} for role, text in zip(self.roles[start:], self.texts[start:])]
+        contents += [{"role": HISTORY_ROLES[role], "parts": [{"text": text}]} for role, text in zip(self.roles[:self.head], self.texts[:self.head])] # Без склеенных копий ролей и текстов
+        return contents
+
 def init_history_db():
     sql_create_table = "CREATE TABLE IF NOT EXISTS chat_messages (id SERIAL PRIMARY KEY, chat_id BIGINT NOT NULL, message_timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, role TEXT NOT NULL, content TEXT NOT NULL);"
     sql_create_index = "CREATE INDEX IF NOT EXISTS idx_chat_id_timestamp_desc ON chat_messages (chat_id, message_timestamp DESC);"
+    sql_create_pending = "CREATE TABLE IF NOT EXISTS pending_replies (reply_uuid TEXT PRIMARY KEY, chat_id BIGINT NOT NULL, business_connection_id TEXT, raw TEXT NOT NULL, parts TEXT NOT NULL, created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);"
     try:
         with psycopg.connect(DATABASE_URL) as conn:
-            with conn.cursor() as cur: logger.debug("Executing CREATE TABLE IF NOT EXISTS..."); cur.execute(sql_create_table); logger.debug("Executing CREATE INDEX IF NOT EXISTS..."); cur.execute(sql_create_index); conn.commit()
-        logger.info("PostgreSQL table 'chat_messages' and index checked/created.")
-    except psycopg.Error as e: logger.critical(f"CRITICAL: Failed to initialize history DB table/index: {e}", exc_info=True); exit()
+            with conn.cursor() as cur: logger.debug("Executing CREATE TABLE IF NOT EXISTS..."); cur.execute(sql_create_table); logger.debug("Executing CREATE INDEX IF NOT EXISTS..."); cur.execute(sql_create_index); cur.execute(sql_create_pending); conn.commit()
+        logger.info("PostgreSQL tables 'chat_messages', 'pending_replies' and index checked/created.")
+    except psycopg.Error as e: logger.critical("CRITICAL: Failed to initialize history DB table/index: %s", e, exc_info=True); exit()
 def update_chat_history(chat_id: int, role: str, text: str):
-    if not text or not text.strip(): logger.warning(f"Attempted to add empty message to history for chat {chat_id}. Skipping."); return
-    clean_text = text.strip(); sql_insert = "INSERT INTO chat_messages (chat_id, role, content) VALUES (%s, %s, %s);"
+    clean_text = text.strip() if text else "" # Одна обрезка и для проверки, и для записи
+    if not clean_text: logger.warning("Attempted to add empty message to history for chat %s. Skipping.", chat_id); return
+    sql_insert = "INSERT INTO chat_messages (chat_id, role, content) VALUES (%s, %s, %s);"
     try:
         with psycopg.connect(DATABASE_URL) as conn:
             with conn.cursor() as cur: cur.execute(sql_insert, (chat_id, role, clean_text)); conn.commit()
-        logger.debug(f"Saved message to DB for chat {chat_id}. Role: {role}, Text: '{clean_text[:30]}...'")
-    except psycopg.Error as e: logger.error(f"Failed to save message to history DB for chat {chat_id}: {e}")
+        cached_history = chat_histories.get(chat_id)
+        if cached_history is not None: cached_history.append(role, clean_text)
+        logger.debug("Saved message to DB for chat %s. Role: %s, Text: '%s...'", chat_id, role, clean_text[:30])
+    except psycopg.Error as e: logger.error("Failed to save message to history DB for chat %s: %s", chat_id, e)
+def replace_last_user_message(chat_id: int, message_id: int, text: str) -> bool:
+    # Правка последнего сообщения собеседника почти без изменений: заменяем его на месте, без новой генерации
+    if last_user_message_ids.get(chat_id) != message_id: return False # Правили не последнее сообщение (или не знаем какое) - идем обычным путем
+    history_ring = chat_histories.get(chat_id); clean_text = text.strip()
+    if history_ring is None or not clean_text: return False
+    last_role, last_text = history_ring.last()
+    if last_role != "user": return False
+    matcher = SequenceMatcher(None, last_text, clean_text) # quick-оценки - только дешевый отсев, решает ratio() с учетом порядка символов
+    if matcher.real_quick_ratio() <= EDIT_SIMILARITY_THRESHOLD or matcher.quick_ratio() <= EDIT_SIMILARITY_THRESHOLD or matcher.ratio() <= EDIT_SIMILARITY_THRESHOLD: return False
+    sql_update = "UPDATE chat_messages SET content = %s WHERE id = (SELECT id FROM chat_messages WHERE chat_id = %s ORDER BY message_timestamp DESC LIMIT 1) AND role = 'user';"
+    try:
+        with psycopg.connect(DATABASE_URL) as conn:
+            with conn.cursor() as cur: cur.execute(sql_update, (clean_text, chat_id)); updated = cur.rowcount == 1; conn.commit()
+    except psycopg.Error as e: logger.error("Failed to update last history message in DB for chat %s: %s", chat_id, e); return False
+    if updated: history_ring.replace_last_text(clean_text); logger.debug("Replaced last user message in chat %s after a minor edit.", chat_id)
+    return updated
 def get_formatted_history(chat_id: int) -> list:
     sql_select = "SELECT role, content FROM chat_messages WHERE chat_id = %s ORDER BY message_timestamp DESC LIMIT %s;"
-    gemini_history = []
+    cached_history = chat_histories.get(chat_id)
+    if cached_history is not None: chat_histories.move_to_end(chat_id); logger.debug("History cache hit for chat %s (%s entries).", chat_id, len(cached_history)); return cached_history.to_contents()
     try:
         with psycopg.connect(DATABASE_URL) as conn:
             with conn.cursor() as cur: cur.execute(sql_select, (chat_id, MAX_HISTORY_PER_CHAT)); db_rows = cur.fetchall()
-        for row in reversed(db_rows): role, content = row; gemini_history.append({"role": role, "parts": [{"text": content}]})
-        logger.debug(f"Retrieved {len(gemini_history)} history entries from DB for chat {chat_id}.")
-        return gemini_history
-    except psycopg.Error as e: logger.error(f"Failed to retrieve history from DB for chat {chat_id}: {e}"); return []
+        history_ring = ChatRing(MAX_HISTORY_PER_CHAT)
+        for row in reversed(db_rows): role, content = row; history_ring.append(role, content)
+        logger.debug("Retrieved %s history entries from DB for chat %s.", len(history_ring), chat_id)
+        chat_histories[chat_id] = history_ring # BoundedDict сам вытеснит самый давний чат
+        return history_ring.to_contents()
+    except psycopg.Error as e: logger.error("Failed to retrieve history from DB for chat %s: %s", chat_id, e); return []
+def save_pending_reply(reply_uuid: str, pending_data: tuple):
+    # Подсказки переживают рестарт бота; заодно чистим протухшие
+    message_parts, raw, business_connection_id, chat_id, _created_at = pending_data
+    sql_insert = "INSERT INTO pending_replies (reply_uuid, chat_id, business_connection_id, raw, parts) VALUES (%s, %s, %s, %s, %s);"
+    sql_expire = "DELETE FROM pending_replies WHERE created_at < now() - make_interval(secs => %s);"
+    try:
+        with psycopg.connect(DATABASE_URL) as conn:
+            with conn.cursor() as cur: cur.execute(sql_insert, (reply_uuid, chat_id, business_connection_id, raw, orjson.dumps(message_parts).decode())); cur.execute(sql_expire, (PENDING_REPLY_TTL,)); conn.commit()
+    except psycopg.Error as e: logger.error("Failed to persist pending reply %s for chat %s: %s", reply_uuid, chat_id, e)
+def take_pending_reply(reply_uuid: str) -> tuple | None:
+    sql_take = "DELETE FROM pending_replies WHERE reply_uuid = %s RETURNING parts, raw, business_connection_id, chat_id, created_at >= now() - make_interval(secs => %s);"
+    try:
+        with psycopg.connect(DATABASE_URL) as conn:
+            with conn.cursor() as cur: cur.execute(sql_take, (reply_uuid, PENDING_REPLY_TTL)); row = cur.fetchone(); conn.commit()
+    except psycopg.Error as e: logger.error("Failed to take pending reply %s from DB: %s", reply_uuid, e); return None
+    if row is None or not row[4]: return None
+    return (tuple(orjson.loads(row[0])), row[1], row[2], row[3], asyncio.get_running_loop().time())
+async def _sweep_pending_replies():
+    # pending_replies упорядочен по времени вставки, так что протухшие подсказки всегда в начале
+    while True:
+        await asyncio.sleep(PENDING_REPLY_SWEEP_INTERVAL)
+        expire_before = asyncio.get_running_loop().time() - PENDING_REPLY_TTL; expired = 0
+        while pending_replies and next(iter(pending_replies.values()))[4] < expire_before: pending_replies.popitem(last=False); expired += 1
+        if expired: logger.info("Expired %s pending replies older than %s s from memory.", expired, PENDING_REPLY_TTL)
 
 # --- Функция для вызова Gemini API (без изменений) ---
 # ... (код generate_gemini_response) ...
-async def generate_gemini_response(contents: list) -> str | None:
-    global gemini_model;
+async def generate_gemini_response(contents: list, on_progress=None) -> str | None:
     if not gemini_model: logger.error("Gemini model not initialized!"); return None
     if not contents: logger.warning("Cannot generate response for empty contents list."); return None
-    logger.info(f"Sending request to Gemini with {len(contents)} content entries.")
+    # Single-flight: одинаковые одновременные запросы ждут один общий вызов Gemini
+    key = hashlib.blake2b(orjson.dumps(contents), digest_size=16).digest()
+    recent = gemini_recent_results.get(key)
+    if recent is not None and recent[0] > asyncio.get_running_loop().time(): logger.info("Identical Gemini request answered moments ago, reusing its result."); return recent[1]
+    entry = gemini_inflight.get(key)
+    if entry is None:
+        entry = gemini_inflight[key] = [asyncio.create_task(_generate_gemini_response(contents, on_progress)), 0] # Прогресс видит только тот, кто запустил вызов
+        entry[0].add_done_callback(lambda _task, key=key, entry=entry: gemini_inflight.pop(key, None) if gemini_inflight.get(key) is entry else None)
+        entry[0].add_done_callback(lambda task, key=key: _remember_gemini_result(key, task))
+    else: logger.info("Identical Gemini request already in flight, waiting for its result.")
+    entry[1] += 1
+    try: return await asyncio.shield(entry[0]) # shield: отмена одного ожидающего не отменяет вызов для остальных
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and not entry[0].done(): # Ответ больше никому не нужен
+            entry[0].cancel()
+            if gemini_inflight.get(key) is entry: gemini_inflight.pop(key, None)
+
+def _remember_gemini_result(key: bytes, task: asyncio.Task):
+    if not task.cancelled() and task.exception() is None and task.result(): gemini_recent_results[key] = (asyncio.get_running_loop().time() + GEMINI_RESULT_TTL, task.result())
+
+async def _generate_gemini_response(contents: list, on_progress=None) -> str | None:
+    logger.info("Sending request to Gemini with %s content entries.", len(contents))
     try:
-        response = await gemini_model.generate_content_async(contents=contents, generation_config=genai.types.GenerationConfig(temperature=0.7),
-            safety_settings={'HARM_CATEGORY_HARASSMENT': 'block_none', 'HARM_CATEGORY_HATE_SPEECH': 'block_none', 'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'block_none', 'HARM_CATEGORY_DANGEROUS_CONTENT': 'block_none'})
+        async with gemini_semaphore: # Ограничиваем число одновременных запросов к Gemini
+            response = await gemini_model.generate_content_async(contents=contents, stream=True)
+            streamed_text = ""
+            async for chunk in response: # Куски приходят по мере генерации; после цикла response содержит весь ответ
+                streamed_text += "".join(part.text for part in chunk.parts)
+                if on_progress: on_progress(streamed_text)
         if response and response.parts:
             generated_text = "".join(part.text for part in response.parts).strip()
-            if generated_text and "cannot fulfill" not in generated_text.lower() and "unable to process" not in generated_text.lower():
-                 logger.info(f"Received response from Gemini: '{generated_text[:50]}...'"); return generated_text
-            else: logger.warning(f"Gemini returned empty/refusal: {response.text if hasattr(response, 'text') else '[No text]'}")
-        elif response and response.prompt_feedback: logger.warning(f"Gemini request blocked: {response.prompt_feedback}")
-        else: logger.warning(f"Gemini returned unexpected structure: {response}")
+            if generated_text and not REFUSAL_RE.search(generated_text):
+                 logger.info("Received response from Gemini: '%s...'", generated_text[:50]); return generated_text
+            else: logger.warning("Gemini returned empty/refusal: %s", response.text if hasattr(response, 'text') else '[No text]')
+        elif response and response.prompt_feedback: logger.warning("Gemini request blocked: %s", response.prompt_feedback)
+        else: logger.warning("Gemini returned unexpected structure: %s", response)
         return None
-    except Exception as e: logger.error(f"Error calling Gemini API: {type(e).__name__}: {e}", exc_info=True); return None
+    except Exception as e: logger.error("Error calling Gemini API: %s: %s", type(e).__name__, e, exc_info=True); return None
+
+def get_interlocutor_block(sender_id: int, sender_name: str, intro: str = "Информация о текущем собеседнике (") -> str:
+    prompt_tail = CHAR_PROMPT_TAILS.get(sender_id) # Хвост с ID и описанием собран при загрузке конфига
+    return intro + sender_name + prompt_tail if prompt_tail else ""
+
+# --- Экранирование HTML одним проходом str.translate (то же, что html.escape) ---
+HTML_ESCAPE_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+def escape_html(text: str) -> str: return text.translate(HTML_ESCAPE_TABLE)
+
+# --- Сборка HTML превью предложенного ответа ---
+# Шапка с экранированным именем собирается один раз на генерацию, дальше к ней дописывается только текст ответа
+def _build_preview_header(chat_id: int, sender_name: str) -> str:
+    return f"🤖 <b>Предложенный ответ для чата {chat_id}</b> (<i>{escape_html(sender_name)}</i>):\n──────────────────\n<code>"
+def _build_preview_html(preview_header: str, preview_text: str) -> str: return preview_header + escape_html(preview_text) + "</code>"
+
+# --- Превью, которое дописывается по мере стриминга ответа Gemini ---
+# Правки уходят в Telegram из отдельной задачи: стрим Gemini (и слот семафора) не ждет Bot API
+class PreviewStream:
+    __slots__ = ("chat_id", "header", "bot", "message", "edited_at", "closed", "pending_text", "sender")
+    def __init__(self, chat_id: int, sender_name: str, bot):
+        self.chat_id = chat_id; self.header = _build_preview_header(chat_id, sender_name); self.bot = bot; self.message = None; self.edited_at = 0.0; self.closed = False
+        self.pending_text = None; self.sender = None
+    def update(self, text: str):
+        text = text.strip()
+        if self.closed or not text or "!fetchcalc".startswith(text) or text.startswith("!fetchcalc"): return # Сигнал календаря не показываем
+        now = asyncio.get_running_loop().time()
+        if now - self.edited_at < STREAM_EDIT_INTERVAL: return
+        self.edited_at = now; self.pending_text = text # Пока идет предыдущая правка, копится только самый свежий текст
+        if self.sender is None or self.sender.done(): self.sender = asyncio.create_task(self._drain())
+    async def _drain(self):
+        while self.pending_text is not None and not self.closed:
+            text = self.pending_text; self.pending_text = None
+            preview_html = _build_preview_html(self.header, NEWMSG_SPLIT_RE.sub("\n\n🔚\n\n", text) + " ▌")
+            try:
+                await telegram_rate_limiter.acquire() # Превью делят общий лимит Bot API с отправкой ответов
+                if self.message is None: self.message = await self.bot.send_message(chat_id=MY_TELEGRAM_ID, text=preview_html, parse_mode=ParseMode.HTML, link_preview_options=NO_LINK_PREVIEW)
+                else: await self.message.edit_text(text=preview_html, parse_mode=ParseMode.HTML, link_preview_options=NO_LINK_PREVIEW)
+            except TelegramError as e: logger.debug("Failed to update streaming preview for chat %s: %s", self.chat_id, e)
+    async def settle(self):
+        self.closed = True # Дальше превью меняет только финальная правка
+        if self.sender is not None: await self.sender
+    async def discard(self):
+        await self.settle() # Общий single-flight вызов может продолжать стримить для других ожидающих
+        if self.message is None: return
+        try: await telegram_rate_limiter.acquire(); await self.message.delete()
+        except TelegramError as e: logger.warning("Failed to delete streaming preview for chat %s: %s", self.chat_id, e)
+        self.message = None
 
 # --- ИЗМЕНЕННАЯ Функция обработки чата ПОСЛЕ задержки ---
 async def process_chat_after_delay(
     chat_id: int,
     sender_name: str,
-    sender_id_str: str,
+    sender_id: int,
     business_connection_id: str | None,
     context: ContextTypes.DEFAULT_TYPE
 ):
-    logger.info(f"Debounce timer expired for chat {chat_id} with sender {sender_id_str}. Processing...")
+    logger.info("Debounce timer expired for chat %s with sender %s. Processing...", chat_id, sender_id)
+    preview_stream = PreviewStream(chat_id, sender_name, context.bot)
+    try: await _process_chat(chat_id, sender_name, sender_id, business_connection_id, context, preview_stream)
+    except asyncio.CancelledError: # Новое сообщение отменило генерацию - недописанное превью убираем в фоне
+        preview_stream.closed = True
+        if preview_stream.sender is not None: context.application.create_task(preview_stream.discard())
+        raise
+
+async def _process_chat(chat_id: int, sender_name: str, sender_id: int, business_connection_id: str | None, context: ContextTypes.DEFAULT_TYPE, preview_stream: PreviewStream):
     current_history = get_formatted_history(chat_id)
+    if not current_history or current_history[-1]["role"] == "model": logger.info("Last turn in chat %s is already ours, skipping Gemini.", chat_id); return
     saratov_time_str = get_saratov_datetime_info()
 
-    initial_contents = []
-    context_block_text = ""
-    if MY_CHARACTER_DESCRIPTION: context_block_text += f"Немного информации обо мне ({MY_NAME_FOR_HISTORY}):\n{MY_CHARACTER_DESCRIPTION}\n\n"
-    interlocutor_description = CHAR_DESCRIPTIONS.get(sender_id_str)
-    if interlocutor_description: context_block_text += f"Информация о текущем собеседнике ({sender_name}, ID: {sender_id_str}):\n{interlocutor_description}\n\n"
-    context_block_text += f"Текущее время в Саратове (где находится Киткат): {saratov_time_str}\n\n"
-    if TOOLS_PROMPT: context_block_text += f"Инструкции по инструментам:\n{TOOLS_PROMPT}\n\n"
-    if context_block_text.strip(): initial_contents.append({"role": "model", "parts": [{"text": context_block_text.strip()}]})
+    # Статичные части блока собраны при загрузке конфига, здесь только подставляем время
+    context_block_text = f"{MY_CONTEXT_BLOCK}{get_interlocutor_block(sender_id, sender_name)}Текущее время в Саратове (где находится Киткат): {saratov_time_str}\n\n{TOOLS_CONTEXT_BLOCK}"
+    initial_contents = [{"role": "model", "parts": [{"text": context_block_text.strip()}]}]
     initial_contents.extend(current_history)
 
     logger.debug("Attempting initial Gemini call...")
-    gemini_response_raw = await generate_gemini_response(initial_contents)
+    gemini_response_raw = await generate_gemini_response(initial_contents, preview_stream.update)
 
     if gemini_response_raw == "!fetchcalc":
         # ... (логика для !fetchcalc без изменений) ...
-        logger.info(f"Received '!fetchcalc' signal for chat {chat_id}. Fetching calendar info...")
+        logger.info("Received '!fetchcalc' signal for chat %s. Fetching calendar info...", chat_id)
         calendar_content = "Информация из календаря недоступна."
         try:
             with open(CALENDAR_FILE, 'r', encoding='utf-8') as f: calendar_content = f.read().strip()
-            if not calendar_content: logger.warning(f"Calendar file '{CALENDAR_FILE}' is empty."); calendar_content = "Файл календаря пуст."
-            else: logger.info(f"Successfully read calendar file '{CALENDAR_FILE}'.")
-        except FileNotFoundError: logger.error(f"Calendar file '{CALENDAR_FILE}' not found!")
-        except Exception as e: logger.error(f"Error reading calendar file '{CALENDAR_FILE}': {e}")
+            if not calendar_content: logger.warning("Calendar file '%s' is empty.", CALENDAR_FILE); calendar_content = "Файл календаря пуст."
+            else: logger.info("Successfully read calendar file '%s'.", CALENDAR_FILE)
+        except FileNotFoundError: logger.error("Calendar file '%s' not found!", CALENDAR_FILE)
+        except Exception as e: logger.error("Error reading calendar file '%s': %s", CALENDAR_FILE, e)
         calendar_prompt_contents = []
         calendar_intro = (f"Для ответа на предыдущий вопрос пользователя требуется информация из его расписания.\n"
                           f"Текущая дата и время в Саратове (где находится пользователь Киткат): {saratov_time_str}\n"
                           f"Вот предоставленное пользователем расписание (содержимое файла {CALENDAR_FILE}):\n------\n{calendar_content}\n------\n"
                           f"Пожалуйста, проанализируй это расписание и текущее время, и ответь на последний вопрос пользователя, следуя основной инструкции и стилю Китката.")
-        context_block_text_for_calendar = ""
-        if MY_CHARACTER_DESCRIPTION: context_block_text_for_calendar += f"Напомню информацию обо мне ({MY_NAME_FOR_HISTORY}):\n{MY_CHARACTER_DESCRIPTION}\n\n"
-        if interlocutor_description: context_block_text_for_calendar += f"Напомню информацию о собеседнике ({sender_name}, ID: {sender_id_str}):\n{interlocutor_description}\n\n"
+        context_block_text_for_calendar = MY_CONTEXT_REMINDER_BLOCK + get_interlocutor_block(sender_id, sender_name, "Напомню информацию о собеседнике (")
         context_block_text_for_calendar += f"Текущее время в Саратове: {saratov_time_str}\n\n"
         if context_block_text_for_calendar.strip(): calendar_prompt_contents.append({"role": "model", "parts": [{"text": context_block_text_for_calendar.strip()}]})
         calendar_prompt_contents.append({"role": "user", "parts": [{"text": calendar_intro}]})
         calendar_prompt_contents.extend(current_history)
         logger.debug("Attempting second Gemini call with calendar info...")
-        gemini_response_raw = await generate_gemini_response(calendar_prompt_contents)
-        if not gemini_response_raw: logger.error(f"Second Gemini call (with calendar) failed for chat {chat_id}.")
+        gemini_response_raw = await generate_gemini_response(calendar_prompt_contents, preview_stream.update)
+        if not gemini_response_raw: logger.error("Second Gemini call (with calendar) failed for chat %s.", chat_id)
 
 
     if gemini_response_raw and gemini_response_raw != "!fetchcalc":
-        reply_uuid = str(uuid.uuid4())
-        pending_replies[reply_uuid] = (gemini_response_raw, business_connection_id, chat_id)
-        logger.debug(f"Stored final pending reply with UUID {reply_uuid}")
-        preview_text = gemini_response_raw.replace("!NEWMSG!", "\n\n🔚\n\n")
+        message_parts = tuple(part for part in NEWMSG_SPLIT_RE.split(gemini_response_raw.strip()) if part) # Делим один раз, а не при нажатии кнопки
+        if not message_parts: logger.warning("Gemini response for chat %s has no non-empty parts. Not sending a preview.", chat_id); await preview_stream.discard(); return
+        reply_uuid = uuid.uuid4().hex # 32 символа без дефисов - короче callback_data
+        pending_replies[reply_uuid] = pending_data = (message_parts, gemini_response_raw, business_connection_id, chat_id, asyncio.get_running_loop().time())
+        save_pending_reply(reply_uuid, pending_data)
+        logger.debug("Stored final pending reply with UUID %s (%s parts)", reply_uuid, len(message_parts))
+        preview_text = "\n\n🔚\n\n".join(message_parts)
         try:
             # --- ДОБАВЛЕН ЛОГ перед отправкой ---
-            logger.info(f"Attempting to send suggestion preview to MY_TELEGRAM_ID: {MY_TELEGRAM_ID} (type: {type(MY_TELEGRAM_ID)})")
+            logger.info("Attempting to send suggestion preview to MY_TELEGRAM_ID: %s (type: %s)", MY_TELEGRAM_ID, type(MY_TELEGRAM_ID))
             if MY_TELEGRAM_ID is None: # Дополнительная проверка на всякий случай
                 logger.error("CRITICAL: MY_TELEGRAM_ID is None before sending preview! Cannot send.")
                 return # Прерываем, если ID не установлен
 
-            safe_sender_name = html.escape(sender_name); escaped_preview_text = html.escape(preview_text)
-            reply_text_html = (f"🤖 <b>Предложенный ответ для чата {html.escape(str(chat_id))}</b> (<i>{safe_sender_name}</i>):\n"
-                               f"──────────────────\n<code>{escaped_preview_text}</code>")
+            reply_text_html = _build_preview_html(preview_stream.header, preview_text)
             callback_data = f"send_{reply_uuid}";
             keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Отправить в чат", callback_data=callback_data)]])
-            await context.bot.send_message(
-                chat_id=MY_TELEGRAM_ID, # Используем MY_TELEGRAM_ID
-                text=reply_text_html,
-                reply_markup=keyboard,
-                parse_mode=ParseMode.HTML
-            )
-            logger.info(f"Sent suggestion preview (UUID: {reply_uuid}) for target_chat {chat_id} to {MY_TELEGRAM_ID}")
+            await preview_stream.settle(); await telegram_rate_limiter.acquire()
+            if preview_stream.message is not None: # Превью уже показано по ходу стриминга - дописываем и добавляем кнопку
+                await preview_stream.message.edit_text(text=reply_text_html, reply_markup=keyboard, parse_mode=ParseMode.HTML, link_preview_options=NO_LINK_PREVIEW)
+            else:
+                await context.bot.send_message(
+                    chat_id=MY_TELEGRAM_ID, # Используем MY_TELEGRAM_ID
+                    text=reply_text_html,
+                    reply_markup=keyboard,
+                    parse_mode=ParseMode.HTML,
+                    link_preview_options=NO_LINK_PREVIEW # Telegram не тратит время на разворачивание ссылок из ответа
+                )
+            logger.info("Sent suggestion preview (UUID: %s) for target_chat %s to %s", reply_uuid, chat_id, MY_TELEGRAM_ID)
         except TelegramError as e:
-            logger.error(f"Failed to send suggestion preview (HTML) to MY_TELEGRAM_ID {MY_TELEGRAM_ID}: {e}", exc_info=True) # Добавил exc_info
+            logger.error("Failed to send suggestion preview (HTML) to MY_TELEGRAM_ID %s: %s", MY_TELEGRAM_ID, e, exc_info=True) # Добавил exc_info
             # ... (fallback) ...
     elif gemini_response_raw == "!fetchcalc":
-        logger.error(f"Gemini returned '!fetchcalc' even after providing calendar data for chat {chat_id}.")
+        logger.error("Gemini returned '!fetchcalc' even after providing calendar data for chat %s.", chat_id); await preview_stream.discard()
     else:
-        logger.warning(f"No response generated by Gemini for chat {chat_id} after debounce (final).")
-
-    if chat_id in debounce_tasks: del debounce_tasks[chat_id]; logger.debug(f"Removed completed debounce task for chat {chat_id}")
+        logger.warning("No response generated by Gemini for chat %s after debounce (final).", chat_id); await preview_stream.discard()
+
+# --- Дебаунс: таймер loop.call_later на чат, новое сообщение только сдвигает отметку времени ---
+class DebounceState:
+    __slots__ = ("args", "last_message_at", "timer", "task", "processing")
+    def __init__(self, args: tuple, last_message_at: float):
+        self.args = args; self.last_message_at = last_message_at; self.timer = None; self.task = None; self.processing = False
+    def cancel(self):
+        if self.timer: self.timer.cancel()
+        if self.task and not self.task.done(): self.task.cancel()
+
+def _on_debounce_fired(chat_id: int, state: DebounceState, context: ContextTypes.DEFAULT_TYPE):
+    if debounce_state.get(chat_id) is not state: return
+    loop = asyncio.get_running_loop()
+    if (remaining := state.last_message_at + DEBOUNCE_DELAY - loop.time()) > 0: # За время ожидания пришли новые сообщения
+        state.timer = loop.call_later(remaining, _on_debounce_fired, chat_id, state, context); return
+    logger.debug("Debounce delay finished for chat %s. Processing.", chat_id)
+    state.processing = True; state.timer = None
+    state.task = asyncio.create_task(_process_debounced(chat_id, state, context)) # Отдельная задача на чат; Gemini ограничивает gemini_semaphore
+
+async def _process_debounced(chat_id: int, state: DebounceState, context: ContextTypes.DEFAULT_TYPE):
+    try: await process_chat_after_delay(chat_id, *state.args, context)
+    except asyncio.CancelledError: logger.info("Processing for chat %s was cancelled.", chat_id); raise
+    except Exception as e: logger.error("Error in delayed processing for chat %s: %s", chat_id, e, exc_info=True)
+    finally:
+        if debounce_state.get(chat_id) is state: debounce_state.pop(chat_id, None); logger.debug("Removed completed debounce state for chat %s", chat_id)
+
+def _schedule_debounce(chat_id: int, sender_name: str, sender_id: int, business_connection_id: str | None, context: ContextTypes.DEFAULT_TYPE):
+    loop = asyncio.get_running_loop(); args = (sender_name, sender_id, business_connection_id)
+    state = debounce_state.get(chat_id)
+    if state is not None and not state.processing: # Еще ждем - только отмечаем время, таймер сам перепланируется при срабатывании
+        state.args = args; state.last_message_at = loop.time(); logger.debug("Extended debounce deadline for chat %s", chat_id); return
+    _cancel_debounce(chat_id) # Уже идет генерация - перезапускаем с учетом нового сообщения
+    state = DebounceState(args, loop.time()); debounce_state[chat_id] = state
+    state.timer = loop.call_later(DEBOUNCE_DELAY, _on_debounce_fired, chat_id, state, context)
+    logger.debug("Scheduled debounce timer for chat %s", chat_id)
+
+def _cancel_debounce(chat_id: int):
+    state = debounce_state.pop(chat_id, None) # Один поиск в словаре вместо двух
+    if state: state.cancel(); logger.debug("Cancelled debounce for chat %s", chat_id)
 
 # --- Остальные функции (handle_business_update, button_handler, post_init, __main__) БЕЗ ИЗМЕНЕНИЙ ---
 # ... (код handle_business_update) ...
 async def handle_business_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # logger.info(f"--- Received Update ---:\n{json.dumps(update.to_dict(), indent=2, ensure_ascii=False)}") # Раскомментируй для отладки
-    message_to_process = None; business_connection_id = None
-    if update.business_message: message_to_process = update.business_message; business_connection_id = message_to_process.business_connection_id; logger.info(f"--- Received Business Message (ID: {message_to_process.message_id}, ConnID: {business_connection_id}) ---")
-    elif update.edited_business_message: message_to_process = update.edited_business_message; business_connection_id = getattr(message_to_process, 'business_connection_id', None); logger.info(f"--- Received Edited Business Message (ID: {message_to_process.message_id}, ConnID: {business_connection_id}) ---")
-    else: return
-
-    chat = message_to_process.chat; sender = message_to_process.from_user; text = message_to_process.text
-    if not text: logger.debug(f"Ignoring non-text business message in chat {chat.id}"); return
-
-    chat_id = chat.id; sender_id_str = str(sender.id) if sender else None; sender_name = "Unknown"
-    if sender: sender_name = sender.first_name or f"User_{sender_id_str}"
-
-    if sender and sender.id == MY_TELEGRAM_ID and text.startswith("/v "): # Обработка /v
-        transcription = text[3:].strip()
-        if transcription:
-            logger.info(f"Processing /v command in chat {chat_id}. Transcription: '{transcription[:30]}...'")
-            update_chat_history(chat_id, "user", transcription)
-            logger.info(f"Message with /v command in chat {chat_id} was not deleted (deletion disabled).")
-            fictional_sender_name_for_suggestion = chat.first_name or f"Chat_{chat_id}"; fictional_sender_id_for_description = str(chat_id)
-            async def delayed_processing_for_v_command():
-                try:
-                    await asyncio.sleep(DEBOUNCE_DELAY)
-                    logger.debug(f"Debounce for /v in chat {chat_id} finished. Starting processing.")
-                    await process_chat_after_delay(chat_id, fictional_sender_name_for_suggestion, fictional_sender_id_for_description, business_connection_id, context)
-                except asyncio.CancelledError: logger.info(f"Debounce task for /v in chat {chat_id} was cancelled.")
-                except Exception as e: logger.error(f"Error in delayed /v processing for chat {chat_id}: {e}", exc_info=True)
-            if chat_id in debounce_tasks:
-                try: debounce_tasks[chat_id].cancel()
-                except Exception: pass
-            task = asyncio.create_task(delayed_processing_for_v_command()); debounce_tasks[chat_id] = task
-            logger.info(f"Scheduled response generation for chat {chat_id} after /v command.")
-        else: logger.warning(f"Received empty /v command from {MY_TELEGRAM_ID} in chat {chat_id}. Ignoring.")
+    if logger.isEnabledFor(logging.DEBUG): logger.debug("--- Received Update ---:\n%s", dump_json(update.to_dict())) # Сериализуем только при DEBUG
+    message_to_process = update.business_message or update.edited_business_message # MessageHandler с BUSINESS_MESSAGES гарантирует одно из двух
+    text = message_to_process.text
+    if not text: logger.debug("Ignoring non-text business message %s", message_to_process.message_id); return # Стикеры/фото отсекаем до любой другой работы
+
+    business_connection_id = message_to_process.business_connection_id
+    logger.info("--- Received %sBusiness Message (ID: %s, ConnID: %s) ---", 'Edited ' if update.business_message is None else '', message_to_process.message_id, business_connection_id)
+    chat = message_to_process.chat; sender = message_to_process.from_user
+    chat_id = chat.id
+
+    if sender is not None and sender.id == MY_TELEGRAM_ID: # Твое сообщение: только /v или запись в историю
+        if text.startswith("/v "): # Обработка /v
+            transcription = text[3:].strip()
+            if transcription:
+                logger.info("Processing /v command in chat %s. Transcription: '%s...'", chat_id, transcription[:30])
+                update_chat_history(chat_id, "user", transcription); last_user_message_ids.pop(chat_id, None)
+                logger.info("Message with /v command in chat %s was not deleted (deletion disabled).", chat_id)
+                fictional_sender_name_for_suggestion = chat.first_name or f"Chat_{chat_id}"; fictional_sender_id_for_description = chat_id
+                _schedule_debounce(chat_id, fictional_sender_name_for_suggestion, fictional_sender_id_for_description, business_connection_id, context)
+                logger.info("Scheduled response generation for chat %s after /v command.", chat_id)
+            else: logger.warning("Received empty /v command from %s in chat %s. Ignoring.", MY_TELEGRAM_ID, chat_id)
+        else:
+            logger.info("Processing OUTGOING business message in chat %s from %s", chat_id, MY_TELEGRAM_ID)
+            update_chat_history(chat_id, "model", text); last_user_message_ids.pop(chat_id, None)
+            _cancel_debounce(chat_id)
         return
 
-    is_outgoing = sender and sender.id == MY_TELEGRAM_ID
-    if is_outgoing: # Твое исходящее сообщение
-        logger.info(f"Processing OUTGOING business message in chat {chat_id} from {sender_id_str}")
-        update_chat_history(chat_id, "model", text)
-        if chat_id in debounce_tasks:
-             logger.debug(f"Cancelling debounce task for chat {chat_id} due to outgoing message.")
-             try: debounce_tasks[chat_id].cancel()
-             except Exception as e: logger.error(f"Error cancelling task for chat {chat_id}: {e}")
-             del debounce_tasks[chat_id]
-        return
+    if not sender: logger.warning("Incoming message in chat %s without sender info. Skipping.", chat_id); return
+    sender_id = sender.id; sender_name = sender.first_name or f"User_{sender_id}"
+    if update.business_message is None and replace_last_user_message(chat_id, message_to_process.message_id, text): logger.info("Minor edit of the last message in chat %s, history updated without regenerating.", chat_id); return
 
-    if not sender: logger.warning(f"Incoming message in chat {chat_id} without sender info. Skipping."); return
-
-    logger.info(f"Processing INCOMING business message from user {sender_id_str} in chat {chat_id} via ConnID: {business_connection_id}")
+    logger.info("Processing INCOMING business message from user %s in chat %s via ConnID: %s", sender_id, chat_id, business_connection_id)
     update_chat_history(chat_id, "user", text) # Добавляем входящее от собеседника
-    if chat_id in debounce_tasks: # Отменяем предыдущий таймер
-        logger.debug(f"Cancelling previous debounce task for chat {chat_id}")
-        try: debounce_tasks[chat_id].cancel()
-        except Exception as e: logger.error(f"Error cancelling task for chat {chat_id}: {e}")
-    logger.info(f"Scheduling new response generation for chat {chat_id} in {DEBOUNCE_DELAY}s")
-    async def delayed_processing(): # Запускаем новый таймер
-        try:
-            await asyncio.sleep(DEBOUNCE_DELAY)
-            logger.debug(f"Debounce delay finished for chat {chat_id}. Starting processing.")
-            await process_chat_after_delay(chat_id, sender_name, sender_id_str, business_connection_id, context)
-        except asyncio.CancelledError: logger.info(f"Debounce task for chat {chat_id} was cancelled.")
-        except Exception as e: logger.error(f"Error in delayed processing for chat {chat_id}: {e}", exc_info=True)
-    task = asyncio.create_task(delayed_processing()); debounce_tasks[chat_id] = task
-    logger.debug(f"Scheduled task {task.get_name()} for chat {chat_id}")
+    last_user_message_ids[chat_id] = message_to_process.message_id
+    logger.info("Scheduling new response generation for chat %s in %ss", chat_id, DEBOUNCE_DELAY)
+    _schedule_debounce(chat_id, sender_name, sender_id, business_connection_id, context)
+
+# --- Глобальный ограничитель частоты отправки в Telegram ---
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate; self.capacity = capacity; self.tokens = float(capacity); self.updated_at = None; self.lock = asyncio.Lock()
+    async def acquire(self):
+        async with self.lock:
+            loop = asyncio.get_running_loop(); now = loop.time()
+            if self.updated_at is not None: self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens < 1: await asyncio.sleep((1 - self.tokens) / self.rate); self.tokens = 1; self.updated_at = loop.time()
+            self.tokens -= 1
+
+telegram_rate_limiter = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+
+# --- Пауза между сообщениями в один чат: части идут по сетке t0 + i*MESSAGE_SPLIT_DELAY от начала прошлой отправки ---
+last_send_at = {} # chat_id -> loop.time() слота последней отправки
+chat_send_locks = {} # chat_id -> [Lock, число нажатий, ждущих или шлющих в этот чат]
+async def _wait_chat_send_slot(chat_id: int):
+    now = asyncio.get_running_loop().time()
+    if len(last_send_at) > LAST_SEND_PRUNE_SIZE: # Старые отметки уже ничего не ограничивают
+        for stale_chat_id in [c for c, t in last_send_at.items() if now - t > MESSAGE_SPLIT_DELAY]: del last_send_at[stale_chat_id]
+    last_sent = last_send_at.get(chat_id)
+    slot = now if last_sent is None else max(now, last_sent + MESSAGE_SPLIT_DELAY)
+    last_send_at[chat_id] = slot # Абсолютный срок: задержка пробуждения и ожидание лимитера не сдвигают следующие части
+    if slot > now: await asyncio.sleep(slot - now)
 
 # ... (код button_handler) ...
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query;
     if not query: logger.warning("Received update without callback_query in button_handler"); return
-    logger.info("--- button_handler triggered ---"); logger.debug(f"CallbackQuery Data: {query.data}")
-    try: await query.answer()
-    except Exception as e: logger.error(f"CRITICAL: Failed to answer callback query: {e}. Stopping handler."); return
+    logger.info("--- button_handler triggered ---"); logger.debug("CallbackQuery Data: %s", query.data)
+    answer_task = asyncio.create_task(query.answer()) # Ответ на callback идет параллельно с отправкой частей
     data = query.data;
-    if not data or not data.startswith("send_"): logger.warning(f"Received unhandled callback_data: {data}"); return
-    reply_uuid = None; response_text_raw = None; final_business_connection_id = None; target_chat_id_for_send = None
+    reply_uuid = data.removeprefix("send_") if data else ""
+    response_text_raw = None; final_business_connection_id = None; target_chat_id_for_send = None
     try:
-        reply_uuid = data.split("_", 1)[1]
-        logger.info(f"Button press: Attempting to process reply with UUID: {reply_uuid}")
-        pending_data = pending_replies.pop(reply_uuid, None)
-        if not pending_data: logger.warning(f"No pending reply found for UUID {reply_uuid}."); await query.edit_message_text(text=query.message.text_html + "\n\n<b>⚠️ Ошибка:</b> Ответ не найден.", parse_mode=ParseMode.HTML, reply_markup=None); return
-        response_text_raw, final_business_connection_id, target_chat_id_for_send = pending_data
-        if not response_text_raw: logger.error(f"Stored raw response_text is None for UUID {reply_uuid}!"); await query.edit_message_text(text=query.message.text_html + "\n\n<b>⚠️ Ошибка:</b> Пустой текст.", parse_mode=ParseMode.HTML, reply_markup=None); return
-        logger.debug(f"Found RAW pending reply for UUID {reply_uuid} (target chat {target_chat_id_for_send}): '{response_text_raw[:50]}...' using ConnID: {final_business_connection_id}")
-        message_parts = [part.strip() for part in response_text_raw.split("!NEWMSG!") if part.strip()]
+        if not reply_uuid or reply_uuid == data: logger.warning("Received unhandled callback_data: %s", data); return
+        base_html = query.message.text_html # text_html пересобирает HTML из entities при каждом обращении
+        logger.info("Button press: Attempting to process reply with UUID: %s", reply_uuid)
+        pending_data = pending_replies.pop(reply_uuid, None); stored_data = take_pending_reply(reply_uuid) # Удаляем из БД в любом случае
+        if not pending_data and stored_data: pending_data = stored_data; logger.info("Pending reply %s restored from DB.", reply_uuid)
+        if not pending_data: logger.warning("No pending reply found for UUID %s.", reply_uuid); await telegram_rate_limiter.acquire(); await query.edit_message_text(text=base_html + "\n\n<b>⚠️ Ошибка:</b> Ответ не найден.", parse_mode=ParseMode.HTML, reply_markup=None, link_preview_options=NO_LINK_PREVIEW); return
+        message_parts, response_text_raw, final_business_connection_id, target_chat_id_for_send, _created_at = pending_data
+        if not response_text_raw: logger.error("Stored raw response_text is None for UUID %s!", reply_uuid); await telegram_rate_limiter.acquire(); await query.edit_message_text(text=base_html + "\n\n<b>⚠️ Ошибка:</b> Пустой текст.", parse_mode=ParseMode.HTML, reply_markup=None, link_preview_options=NO_LINK_PREVIEW); return
+        logger.debug("Found pending reply for UUID %s (target chat %s): '%s...' using ConnID: %s", reply_uuid, target_chat_id_for_send, response_text_raw[:50], final_business_connection_id)
         total_parts = len(message_parts); sent_count = 0; first_error = None
-        if not message_parts: logger.warning(f"Raw response for UUID {reply_uuid} resulted in no parts!"); await query.edit_message_text(text=query.message.text_html + "\n\n<b>⚠️ Ошибка:</b> Пустой ответ.", parse_mode=ParseMode.HTML, reply_markup=None); return
-        logger.info(f"Attempting to send {total_parts} message parts to chat {target_chat_id_for_send}")
-        for i, part_text in enumerate(message_parts):
-            logger.debug(f"Sending part {i+1}/{total_parts} to chat {target_chat_id_for_send}")
-            try:
-                sent_message = await context.bot.send_message(chat_id=target_chat_id_for_send, text=part_text, business_connection_id=final_business_connection_id)
-                logger.info(f"Sent part {i+1}/{total_parts} (MsgID: {sent_message.message_id}) to chat {target_chat_id_for_send}")
-                update_chat_history(target_chat_id_for_send, "model", part_text)
-                sent_count += 1
-                if total_parts > 1 and i < total_parts - 1: await asyncio.sleep(MESSAGE_SPLIT_DELAY)
-            except Exception as e: logger.error(f"Failed to send part {i+1}/{total_parts}: {type(e).__name__}: {e}", exc_info=True); first_error = e; break
-        final_text = query.message.text_html
-        if first_error: error_text = f"<b>❌ Ошибка при отправке части {sent_count + 1}/{total_parts}:</b> {html.escape(str(first_error))}"; final_text += f"\n\n{error_text}"
-        elif sent_count == total_parts: final_text += "\n\n<b>✅ Отправлено!</b>"; logger.info(f"Finished sending all parts for chat {target_chat_id_for_send}.")
-        else: final_text += "\n\n<b>⚠️ Неизвестный результат.</b>"; logger.error(f"Unexpected state after sending parts for {target_chat_id_for_send}.")
-        try: await query.edit_message_text(text=final_text, parse_mode=ParseMode.HTML, reply_markup=None)
-        except Exception as edit_e: logger.error(f"Failed to edit original suggestion message: {edit_e}")
-    except (ValueError, IndexError) as e: logger.error(f"Error parsing callback_data '{data}' or processing reply for UUID {reply_uuid}: {e}");
-    except Exception as e: logger.error(f"Unexpected error in button_handler (UUID {reply_uuid}): {e}", exc_info=True);
+        if not message_parts: logger.warning("Raw response for UUID %s resulted in no parts!", reply_uuid); await telegram_rate_limiter.acquire(); await query.edit_message_text(text=base_html + "\n\n<b>⚠️ Ошибка:</b> Пустой ответ.", parse_mode=ParseMode.HTML, reply_markup=None, link_preview_options=NO_LINK_PREVIEW); return
+        logger.info("Attempting to send %s message parts to chat %s", total_parts, target_chat_id_for_send)
+        send_lock = chat_send_locks.get(target_chat_id_for_send)
+        if send_lock is None: send_lock = chat_send_locks[target_chat_id_for_send] = [asyncio.Lock(), 0]
+        send_lock[1] += 1
+        try:
+            async with send_lock[0]: # Нажатия для одного чата шлют части по очереди, не вперемешку
+                for i, part_text in enumerate(message_parts):
+                    await _wait_chat_send_slot(target_chat_id_for_send); await telegram_rate_limiter.acquire() # Время запроса к Telegram входит в паузу до следующей части
+                    logger.debug("Sending part %s/%s to chat %s", i+1, total_parts, target_chat_id_for_send)
+                    try:
+                        sent_message = await context.bot.send_message(chat_id=target_chat_id_for_send, text=part_text, business_connection_id=final_business_connection_id)
+                        logger.info("Sent part %s/%s (MsgID: %s) to chat %s", i+1, total_parts, sent_message.message_id, target_chat_id_for_send)
+                        update_chat_history(target_chat_id_for_send, "model", part_text) # Сразу: ответ собеседника между частями должен лечь после уже отправленных
+                        sent_count += 1
+                    except Exception as e: logger.error("Failed to send part %s/%s: %s: %s", i+1, total_parts, type(e).__name__, e, exc_info=True); first_error = e; break
+        finally:
+            send_lock[1] -= 1
+            if send_lock[1] == 0: chat_send_locks.pop(target_chat_id_for_send, None)
+        final_text = base_html
+        if first_error: error_text = f"<b>❌ Ошибка при отправке части {sent_count + 1}/{total_parts}:</b> {escape_html(str(first_error))}"; final_text += f"\n\n{error_text}"
+        elif sent_count == total_parts: final_text += "\n\n<b>✅ Отправлено!</b>"; logger.info("Finished sending all parts for chat %s.", target_chat_id_for_send)
+        else: final_text += "\n\n<b>⚠️ Неизвестный результат.</b>"; logger.error("Unexpected state after sending parts for %s.", target_chat_id_for_send)
+        try: await telegram_rate_limiter.acquire(); await query.edit_message_text(text=final_text, parse_mode=ParseMode.HTML, reply_markup=None, link_preview_options=NO_LINK_PREVIEW)
+        except Exception as edit_e: logger.error("Failed to edit original suggestion message: %s", edit_e)
+    except Exception as e: logger.error("Unexpected error in button_handler (UUID %s): %s", reply_uuid, e, exc_info=True);
+    finally:
+        try: await answer_task
+        except Exception as e: logger.error("Failed to answer callback query: %s", e)
 
 # ... (код post_init) ...
+async def _warm_gemini_connection():
+    # Прогреваем канал к Gemini бесплатным count_tokens, чтобы TLS/HTTP2-рукопожатие не досталось первому собеседнику
+    try: await asyncio.wait_for(gemini_model.count_tokens_async("ping"), GEMINI_WARMUP_TIMEOUT); logger.info("Gemini connection warmed up.")
+    except Exception as e: logger.warning("Gemini warmup failed: %s: %s", type(e).__name__, e)
 async def post_init(application: Application):
+    background_tasks.append(asyncio.create_task(_sweep_pending_replies(), name="pending_replies_sweeper"))
+    background_tasks.append(asyncio.create_task(_warm_gemini_connection(), name="gemini_warmup")) # В фоне: установку вебхука не задерживает
     webhook_full_url = f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}"
-    logger.info(f"Attempting to set webhook using: {webhook_full_url}")
+    logger.info("Attempting to set webhook using: %s", webhook_full_url)
     try:
         await application.bot.set_webhook( url=webhook_full_url,
-            allowed_updates=[ "message", "edited_message", "channel_post", "edited_channel_post",
-                "business_connection", "business_message", "edited_business_message",
-                "deleted_business_messages", "my_chat_member", "chat_member", "callback_query"],
+            allowed_updates=["business_message", "edited_business_message", "callback_query"], # Только то, что разбирают хендлеры - остальное Telegram не шлет
             drop_pending_updates=True )
-        webhook_info = await application.bot.get_webhook_info(); logger.info(f"Webhook info after setting: {webhook_info}")
+        webhook_info = await application.bot.get_webhook_info(); logger.info("Webhook info after setting: %s", webhook_info)
         if webhook_info.url == webhook_full_url: logger.info("Webhook successfully set!")
-        else: logger.warning(f"Webhook URL reported differ: {webhook_info.url}")
-    except Exception as e: logger.error(f"Error setting webhook: {e}", exc_info=True)
+        else: logger.warning("Webhook URL reported differ: %s", webhook_info.url)
+    except Exception as e: logger.error("Error setting webhook: %s", e, exc_info=True)
+
+async def post_shutdown(application: Application):
+    for task in background_tasks: task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True); background_tasks.clear()
+    tasks = [state.task for state in debounce_state.values() if state.task and not state.task.done()]
+    for state in debounce_state.values(): state.cancel()
+    if tasks: await asyncio.gather(*tasks, return_exceptions=True); logger.info("Cancelled %s in-flight debounce tasks on shutdown.", len(tasks))
+    debounce_state.clear()
 
 # ... (код __main__) ...
 if __name__ == "__main__":
@@ -376,19 +645,22 @@ if __name__ == "__main__":
     init_history_db()          # Инициализируем БД истории
     try:
         genai.configure(api_key=GEMINI_API_KEY)
-        gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=BASE_SYSTEM_PROMPT) # Задаем базовый промпт
-        logger.info(f"Gemini model '{gemini_model.model_name}' initialized successfully.")
-    except Exception as e: logger.critical(f"CRITICAL: Failed to initialize Gemini: {e}", exc_info=True); exit()
+        gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=BASE_SYSTEM_PROMPT, generation_config=GEMINI_GENERATION_CONFIG, safety_settings=GEMINI_SAFETY_SETTINGS) # Задаем базовый промпт; настройки SDK нормализует один раз здесь
+        logger.info("Gemini model '%s' initialized successfully.", gemini_model.model_name)
+    except Exception as e: logger.critical("CRITICAL: Failed to initialize Gemini: %s", e, exc_info=True); exit()
+
+    application = Application.builder().token(BOT_TOKEN).http_version("2").pool_timeout(TELEGRAM_POOL_TIMEOUT).post_init(post_init).post_shutdown(post_shutdown).build()
+    application.add_handler(MessageHandler(filters.UpdateType.BUSINESS_MESSAGES, handle_business_update)) # Новые и отредактированные - одной проверкой
+    application.add_handler(CallbackQueryHandler(button_handler, block=False)) # Отправка частей с паузами идет в фоне и не держит очередь апдейтов
 
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
-    application.add_handler(MessageHandler(filters.UpdateType.BUSINESS_MESSAGE, handle_business_update))
-    application.add_handler(MessageHandler(filters.UpdateType.EDITED_BUSINESS_MESSAGE, handle_business_update))
-    application.add_handler(CallbackQueryHandler(button_handler))
+    # run_webhook сам крутит цикл из asyncio.get_event_loop(), поэтому задаем цикл, а не Runner; uvloop.install() устарел с Python 3.12
+    try: import uvloop; asyncio.set_event_loop(uvloop.new_event_loop()); logger.info("uvloop event loop installed.")
+    except ImportError: logger.info("uvloop not available, using default asyncio event loop.")
 
     logger.info("Application built. Starting webhook listener...")
     try:
         webhook_full_url = f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}"
         asyncio.run(application.run_webhook(listen="0.0.0.0", port=PORT, url_path=BOT_TOKEN, webhook_url=webhook_full_url))
-    except ValueError as e: logger.critical(f"CRITICAL ERROR asyncio.run: {e}", exc_info=True)
-    except Exception as e: logger.critical(f"CRITICAL ERROR Webhook server: {e}", exc_info=True)
+    except ValueError as e: logger.critical("CRITICAL ERROR asyncio.run: %s", e, exc_info=True)
+    except Exception as e: logger.critical("CRITICAL ERROR Webhook server: %s", e, exc_info=True)
     finally: logger.info("Webhook server shut down.")
\ No newline at end of file